@@ -1,6 +1,9 @@
 import logging
+from bisect import bisect_right
+from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union, cast
+from typing import Any, Callable, DefaultDict, Dict, List, Optional, Tuple, Union, cast
 
 import gevent
 
@@ -9,7 +12,8 @@ from rotkehlchen.accounting.structures import DefiEvent
 from rotkehlchen.assets.asset import Asset
 from rotkehlchen.assets.unknown_asset import UnknownEthereumToken
 from rotkehlchen.chain.ethereum.trades import AMMTrade
-from rotkehlchen.constants.assets import A_BTC, A_ETH
+from rotkehlchen.constants import WEI_DIVISOR, ZERO
+from rotkehlchen.constants.assets import A_BTC, A_ETH, A_KFEE
 from rotkehlchen.csv_exporter import CSVExporter
 from rotkehlchen.db.dbhandler import DBHandler
 from rotkehlchen.db.settings import DBSettings
@@ -30,13 +34,15 @@ from rotkehlchen.exchanges.data_structures import (
 )
 from rotkehlchen.fval import FVal
 from rotkehlchen.history import PriceHistorian
+from rotkehlchen.history.price import BulkPriceQueryResult
 from rotkehlchen.inquirer import Inquirer
 from rotkehlchen.logging import RotkehlchenLogsAdapter
 from rotkehlchen.typing import EthereumTransaction, Fee, Timestamp
 from rotkehlchen.user_messages import MessagesAggregator
 from rotkehlchen.utils.accounting import (
+    ActionAssets,
     TaxableAction,
-    action_get_assets,
+    action_get_assets_safe,
     action_get_timestamp,
     action_get_type,
 )
@@ -45,6 +51,18 @@ from rotkehlchen.utils.misc import timestamp_to_date
 logger = logging.getLogger(__name__)
 log = RotkehlchenLogsAdapter(logger)
 
+# Types of actions that are only accounted for if they happen inside the queried period
+PERIOD_ONLY_ACTION_TYPES = ('asset_movement', 'ethereum_transaction')
+
+
+@lru_cache(maxsize=4096)
+def _action_date(timestamp: Timestamp) -> str:
+    """Formats the timestamp of an action for user facing messages
+
+    Cached since many errors can be reported for actions at the same time
+    """
+    return timestamp_to_date(timestamp, formatstr='%d/%m/%Y, %H:%M:%S')
+
 
 class Accountant():
 
@@ -59,14 +77,27 @@ class Accountant():
         self.db = db
         profit_currency = db.get_main_currency()
         self.msg_aggregator = msg_aggregator
+        self.price_historian = PriceHistorian()
         self.csvexporter = CSVExporter(profit_currency, user_directory, create_csv)
         self.events = TaxableEvents(self.csvexporter, profit_currency)
 
-        self.asset_movement_fees = FVal(0)
+        self.asset_movement_fees = ZERO
         self.last_gas_price = 0
 
         self.started_processing_timestamp = Timestamp(-1)
         self.currently_processing_timestamp = Timestamp(-1)
+        # The method processing each type of action, as returned by action_get_type
+        self._action_handlers: Dict[
+            str,
+            Callable[[TaxableAction, Timestamp, DBSettings], None],
+        ] = {
+            'trade': self._process_trade,
+            'loan': self._process_loan,
+            'asset_movement': self._process_asset_movement,
+            'margin_position': self._process_margin_position,
+            'ethereum_transaction': self._process_ethereum_transaction,
+            'defi_event': self._process_defi_event,
+        }
 
     def __del__(self) -> None:
         del self.events
@@ -110,12 +141,85 @@ class Accountant():
         - RemoteError if there is a problem reaching the price oracle server
         or with reading the response returned by the server
         """
-        fee_rate = PriceHistorian().query_historical_price(
-            from_asset=trade.fee_currency,
+        if trade.fee == ZERO:
+            # No need to ask for the price of the fee currency. Happens for all AMM trades
+            return Fee(ZERO)
+
+        fee_rate = self.events.get_rate_in_profit_currency(trade.fee_currency, trade.timestamp)
+        return Fee(fee_rate * trade.fee)
+
+    def _prefetch_prices(
+            self,
+            actions: List[TaxableAction],
+            action_types: List[str],
+            action_assets: List[ActionAssets],
+            timestamps: List[Timestamp],
+            db_settings: DBSettings,
+    ) -> BulkPriceQueryResult:
+        """Walks the actions once and queries in bulk the profit currency prices
+        that processing them is going to need
+
+        Only the prices that are certainly going to be asked for are prefetched.
+        Returns the found prices and the errors of the failed ones. Those errors are
+        raised, and reported, at the point of use. Anything in neither mapping is
+        queried at the point of use.
+        """
+        needed: DefaultDict[Asset, List[Timestamp]] = defaultdict(list)
+        for action, action_type, assets, timestamp in zip(
+                actions,
+                action_types,
+                action_assets,
+                timestamps,
+        ):
+            if isinstance(assets, (UnknownAsset, UnsupportedAsset, DeserializationError)):
+                continue
+            # Actions with unknown tokens have already been dropped by process_history
+            asset1, asset2 = cast(Tuple[Asset, Optional[Asset]], assets)
+
+            if action_type in ('loan', 'margin_position', 'defi_event'):
+                needed[asset1].append(timestamp)
+            elif action_type == 'asset_movement':
+                movement = cast(AssetMovement, action)
+                should_account = (
+                    movement.asset != A_KFEE and
+                    self.events.account_for_assets_movements
+                )
+                if should_account:
+                    needed[movement.fee_asset].append(timestamp)
+            elif action_type == 'ethereum_transaction':
+                if db_settings.include_gas_costs:
+                    needed[A_ETH].append(timestamp)
+            else:  # trade
+                trade = cast(Trade, action)
+                if trade.fee != ZERO:
+                    needed[trade.fee_currency].append(timestamp)
+                base_asset, quote_asset = asset1, cast(Asset, asset2)
+                if trade.trade_type == TradeType.SETTLEMENT_BUY:
+                    needed[A_BTC].append(timestamp)
+                    continue
+
+                quote_rate_is_queried = (
+                    trade.trade_type != TradeType.BUY or
+                    self.events.include_crypto2crypto or
+                    base_asset.is_fiat() or
+                    quote_asset.is_fiat()
+                )
+                if quote_rate_is_queried:
+                    needed[quote_asset].append(timestamp)
+                # The virtual sell of a buy, or buy of a sell, needs the base asset rate
+                base_rate_is_queried = (
+                    trade.trade_type in (TradeType.BUY, TradeType.SELL) and
+                    self.events.include_crypto2crypto and
+                    not quote_asset.is_fiat()
+                )
+                if base_rate_is_queried:
+                    needed[base_asset].append(timestamp)
+
+        needed.pop(self.profit_currency, None)
+        return self.price_historian.query_historical_prices_bulk(
             to_asset=self.profit_currency,
-            timestamp=trade.timestamp,
+            queries=needed,
         )
-        return Fee(fee_rate * trade.fee)
 
     def add_asset_movement_to_events(self, movement: AssetMovement) -> None:
         """
@@ -129,10 +233,7 @@ class Accountant():
         or with reading the response returned by the server
         """
         timestamp = movement.timestamp
-        if timestamp < self.start_ts:
-            return
-
-        if movement.asset.identifier == 'KFEE' or not self.events.account_for_assets_movements:
+        if movement.asset == A_KFEE or not self.events.account_for_assets_movements:
             # There is no reason to process deposits of KFEE for kraken as it has only value
             # internal to kraken and KFEE has no value and will error at cryptocompare price query
             return
@@ -176,8 +277,6 @@ class Accountant():
         """
         if not include_gas_costs:
             return
-        if transaction.timestamp < self.start_ts:
-            return
 
         if transaction.gas_price == -1:
             gas_price = self.last_gas_price
@@ -186,7 +285,7 @@ class Accountant():
             self.last_gas_price = transaction.gas_price
 
         rate = self.events.get_rate_in_profit_currency(A_ETH, transaction.timestamp)
-        eth_burned_as_gas = FVal(transaction.gas_used * gas_price) / FVal(10 ** 18)
+        eth_burned_as_gas = FVal(transaction.gas_used * gas_price) / WEI_DIVISOR
         cost = eth_burned_as_gas * rate
         self.eth_transactions_gas_costs += cost
 
@@ -281,14 +380,15 @@ class Accountant():
         self.events.reset(start_ts, end_ts)
         self.last_gas_price = 2000000000
         self.start_ts = start_ts
-        self.eth_transactions_gas_costs = FVal(0)
-        self.asset_movement_fees = FVal(0)
+        self.eth_transactions_gas_costs = ZERO
+        self.asset_movement_fees = ZERO
         self.csvexporter.reset_csv_lists()
 
-        # Ask the DB for the settings once at the start of processing so we got the
-        # same settings through the entire task
+        # Ask the DB for the settings and the ignored assets once at the start of
+        # processing so we got the same settings through the entire task
         db_settings = self.db.get_settings()
         self._customize(db_settings)
+        ignored_assets = frozenset(self.db.get_ignored_assets())
 
         actions: List[TaxableAction] = list(trade_history)
         # If we got loans, we need to interleave them with the full history and re-sort
@@ -304,72 +404,132 @@ class Accountant():
         if len(defi_events) != 0:
             actions.extend(defi_events)
 
-        actions.sort(
-            key=lambda action: action_get_timestamp(action),
-        )
+        # Timsort merges the already sorted runs of each source on its own
+        actions.sort(key=action_get_timestamp)
+        # Resolve the type and timestamp of each action only once
+        timestamps = [action_get_timestamp(action) for action in actions]
         # The first ts is the ts of the first action we have in history or 0 for empty history
-        first_ts = Timestamp(0) if len(actions) == 0 else action_get_timestamp(actions[0])
+        first_ts = Timestamp(0) if len(actions) == 0 else timestamps[0]
         self.currently_processing_timestamp = first_ts
         self.started_processing_timestamp = first_ts
 
+        # Nothing after end_ts is processed so cut the sorted actions there
+        end_index = bisect_right(timestamps, end_ts)
+        actions = actions[:end_index]
+        timestamps = timestamps[:end_index]
+        action_types = [action_get_type(action) for action in actions]
+        # Resolving the assets may fail, so do it once and keep the error for later
+        action_assets = [action_get_assets_safe(action) for action in actions]
+        # Trades, loans etc. before start_ts are still needed to know how each asset
+        # was acquired, but asset movements and gas costs only count inside the period.
+        # Actions involving an unknown token or an ignored asset are not processed at
+        # all. Drop them from the columns here so nothing after this has to check.
+        to_keep = []
+        for idx, (action_type, assets, timestamp) in enumerate(zip(
+                action_types,
+                action_assets,
+                timestamps,
+        )):
+            if timestamp < start_ts and action_type in PERIOD_ONLY_ACTION_TYPES:
+                continue
+            if isinstance(assets, tuple):
+                asset1, asset2 = assets
+                if isinstance(asset1, UnknownEthereumToken) or isinstance(asset2, UnknownEthereumToken):  # noqa: E501
+                    log.debug(
+                        'Ignoring action with unknown token',
+                        action_type=action_type,
+                        asset1=asset1,
+                        asset2=asset2,
+                    )
+                    continue
+                if asset1 in ignored_assets or asset2 in ignored_assets:
+                    log.debug(
+                        'Ignoring action with ignored asset',
+                        action_type=action_type,
+                        asset1=asset1,
+                        asset2=asset2,
+                    )
+                    continue
+            to_keep.append(idx)
+        if len(to_keep) != len(actions):
+            actions = [actions[idx] for idx in to_keep]
+            action_types = [action_types[idx] for idx in to_keep]
+            action_assets = [action_assets[idx] for idx in to_keep]
+            timestamps = [timestamps[idx] for idx in to_keep]
+
+        self.events.price_cache, self.events.price_errors = self._prefetch_prices(
+            actions=actions,
+            action_types=action_types,
+            action_assets=action_assets,
+            timestamps=timestamps,
+            db_settings=db_settings,
+        )
+
         prev_time = Timestamp(0)
-        count = 0
-        for action in actions:
+        for count, (action, action_type, assets, ts) in enumerate(zip(
+                actions,
+                action_types,
+                action_assets,
+                timestamps,
+        )):
+            if count % 500 == 0:
+                # This loop can take a very long time depending on the amount of actions
+                # to process. We need to yield to other greenlets or else calls to the
+                # API may time out. Yielding is enough, there is no need to also wait.
+                gevent.sleep(0)
+
             try:
-                (
-                    should_continue,
-                    prev_time,
-                ) = self.process_action(action, end_ts, prev_time, db_settings)
+                prev_time = self.process_action(
+                    action=action,
+                    action_type=action_type,
+                    assets=assets,
+                    timestamp=ts,
+                    prev_time=prev_time,
+                    db_settings=db_settings,
+                )
             except PriceQueryUnsupportedAsset as e:
-                ts = action_get_timestamp(action)
                 self.msg_aggregator.add_error(
                     f'Skipping action at '
-                    f' {timestamp_to_date(ts, formatstr="%d/%m/%Y, %H:%M:%S")} '
+                    f' {_action_date(ts)} '
                     f'during history processing due to an asset unknown to '
                     f'cryptocompare being involved. Check logs for details',
                 )
                 log.error(
-                    f'Skipping action {str(action)} during history processing due to '
-                    f'cryptocompare not supporting an involved asset: {str(e)}',
+                    'Skipping action during history processing due to '
+                    'cryptocompare not supporting an involved asset',
+                    action=action,
+                    error=e,
                 )
                 continue
             except NoPriceForGivenTimestamp as e:
-                ts = action_get_timestamp(action)
                 self.msg_aggregator.add_error(
                     f'Skipping action at '
-                    f' {timestamp_to_date(ts, formatstr="%d/%m/%Y, %H:%M:%S")} '
+                    f' {_action_date(ts)} '
                     f'during history processing due to inability to find a price '
                     f'at that point in time: {str(e)}. Check the logs for more details',
                 )
                 log.error(
-                    f'Skipping action {str(action)} during history processing due to '
-                    f'inability to query a price at that time: {str(e)}',
+                    'Skipping action during history processing due to '
+                    'inability to query a price at that time',
+                    action=action,
+                    error=e,
                 )
                 continue
             except RemoteError as e:
-                ts = action_get_timestamp(action)
                 self.msg_aggregator.add_error(
                     f'Skipping action at '
-                    f' {timestamp_to_date(ts, formatstr="%d/%m/%Y, %H:%M:%S")} '
+                    f' {_action_date(ts)} '
                     f'during history processing due to inability to reach an external '
                     f'service at that point in time: {str(e)}. Check the logs for more details',
                 )
                 log.error(
-                    f'Skipping action {str(action)} during history processing due to '
-                    f'inability to reach an external service at that time: {str(e)}',
+                    'Skipping action during history processing due to '
+                    'inability to reach an external service at that time',
+                    action=action,
+                    error=e,
                 )
                 continue
 
-            if not should_continue:
-                break
-
-            if count % 500 == 0:
-                # This loop can take a very long time depending on the amount of actions
-                # to process. We need to yield to other greenlets or else calls to the
-                # API may time out
-                gevent.sleep(0.5)
-            count += 1
-
         self.events.calculate_asset_details()
         Inquirer().save_historical_forex_data()
 
@@ -404,12 +564,17 @@ class Accountant():
     def process_action(
             self,
             action: TaxableAction,
-            end_ts: Timestamp,
+            action_type: str,
+            assets: ActionAssets,
+            timestamp: Timestamp,
             prev_time: Timestamp,
             db_settings: DBSettings,
-    ) -> Tuple[bool, Timestamp]:
-        """Processes each individual action and returns whether we should continue
-        looping through the rest of the actions or not
+    ) -> Timestamp:
+        """Processes each individual action and returns its timestamp
+
+        The type, assets and timestamp of the action are precomputed by process_history
+        which also makes sure that no action after the end of the period or involving
+        an unknown token or an ignored asset gets here
 
         May raise:
         - PriceQueryUnsupportedAsset if from/to asset is missing from price oracles
@@ -418,92 +583,93 @@ class Accountant():
         - RemoteError if there is a problem reaching the price oracle server
         or with reading the response returned by the server
         """
-        ignored_assets = self.db.get_ignored_assets()
-
         # Assert we are sorted in ascending time order.
-        timestamp = action_get_timestamp(action)
         assert timestamp >= prev_time, (
             "During history processing the trades/loans are not in ascending order"
         )
         prev_time = timestamp
-
-        if timestamp > end_ts:
-            return False, prev_time
-
         self.currently_processing_timestamp = timestamp
 
-        action_type = action_get_type(action)
-
-        try:
-            asset1, asset2 = action_get_assets(action)
-        except UnknownAsset as e:
+        if isinstance(assets, UnknownAsset):
             self.msg_aggregator.add_warning(
-                f'At history processing found trade with unknown asset {e.asset_name}. '
+                f'At history processing found trade with unknown asset {assets.asset_name}. '
                 f'Ignoring the trade.',
             )
-            return True, prev_time
-        except UnsupportedAsset as e:
+            return prev_time
+        if isinstance(assets, UnsupportedAsset):
             self.msg_aggregator.add_warning(
-                f'At history processing found trade with unsupported asset {e.asset_name}. '
+                f'At history processing found trade with unsupported asset {assets.asset_name}. '
                 f'Ignoring the trade.',
             )
-            return True, prev_time
-        except DeserializationError:
+            return prev_time
+        if isinstance(assets, DeserializationError):
             self.msg_aggregator.add_error(
                 'At history processing found trade with non string asset type. '
                 'Ignoring the trade.',
             )
-            return True, prev_time
-
-        if isinstance(asset1, UnknownEthereumToken) or isinstance(asset2, UnknownEthereumToken):  # type: ignore  # noqa: E501
-            # TODO: Typing needs fixing here  # type: ignore
-            log.debug(  # type: ignore
-                'Ignoring action with unknown token',
-                action_type=action_type,
-                asset1=asset1,
-                asset2=asset2,
-            )
-            return True, prev_time
-
-        if asset1 in ignored_assets or asset2 in ignored_assets:
-            log.debug(
-                'Ignoring action with ignored asset',
-                action_type=action_type,
-                asset1=asset1,
-                asset2=asset2,
-            )
-            return True, prev_time
-
-        if action_type == 'loan':
-            action = cast(Loan, action)
-            self.events.add_loan_gain(
-                location=action.location,
-                gained_asset=action.currency,
-                lent_amount=action.amount_lent,
-                gained_amount=action.earned,
-                fee_in_asset=action.fee,
-                open_time=action.open_time,
-                close_time=timestamp,
-            )
-            return True, prev_time
-        if action_type == 'asset_movement':
-            action = cast(AssetMovement, action)
-            self.add_asset_movement_to_events(action)
-            return True, prev_time
-        if action_type == 'margin_position':
-            action = cast(MarginPosition, action)
-            self.events.add_margin_position(margin=action)
-            return True, prev_time
-        if action_type == 'ethereum_transaction':
-            action = cast(EthereumTransaction, action)
-            self.account_for_gas_costs(action, db_settings.include_gas_costs)
-            return True, prev_time
-        if action_type == 'defi_event':
-            action = cast(DefiEvent, action)
-            self.events.add_defi_event(action)
-            return True, prev_time
-
-        # else if we get here it's a trade
+            return prev_time
+
+        self._action_handlers[action_type](action, timestamp, db_settings)
+        return prev_time
+
+    def _process_loan(
+            self,
+            action: TaxableAction,
+            timestamp: Timestamp,
+            db_settings: DBSettings,  # pylint: disable=unused-argument
+    ) -> None:
+        loan = cast(Loan, action)
+        self.events.add_loan_gain(
+            location=loan.location,
+            gained_asset=loan.currency,
+            lent_amount=loan.amount_lent,
+            gained_amount=loan.earned,
+            fee_in_asset=loan.fee,
+            open_time=loan.open_time,
+            close_time=timestamp,
+        )
+
+    def _process_asset_movement(
+            self,
+            action: TaxableAction,
+            timestamp: Timestamp,  # pylint: disable=unused-argument
+            db_settings: DBSettings,  # pylint: disable=unused-argument
+    ) -> None:
+        self.add_asset_movement_to_events(cast(AssetMovement, action))
+
+    def _process_margin_position(
+            self,
+            action: TaxableAction,
+            timestamp: Timestamp,  # pylint: disable=unused-argument
+            db_settings: DBSettings,  # pylint: disable=unused-argument
+    ) -> None:
+        self.events.add_margin_position(margin=cast(MarginPosition, action))
+
+    def _process_ethereum_transaction(
+            self,
+            action: TaxableAction,
+            timestamp: Timestamp,  # pylint: disable=unused-argument
+            db_settings: DBSettings,
+    ) -> None:
+        self.account_for_gas_costs(
+            cast(EthereumTransaction, action),
+            db_settings.include_gas_costs,
+        )
+
+    def _process_defi_event(
+            self,
+            action: TaxableAction,
+            timestamp: Timestamp,  # pylint: disable=unused-argument
+            db_settings: DBSettings,  # pylint: disable=unused-argument
+    ) -> None:
+        self.events.add_defi_event(cast(DefiEvent, action))
+
+    def _process_trade(
+            self,
+            action: TaxableAction,
+            timestamp: Timestamp,  # pylint: disable=unused-argument
+            db_settings: DBSettings,  # pylint: disable=unused-argument
+    ) -> None:
         trade = cast(Trade, action)
         # When you buy, you buy with the cost_currency and receive the other one
         # When you sell, you sell the amount in non-cost_currency and receive
@@ -556,8 +722,6 @@ class Accountant():
             # Should never happen
             raise AssertionError(f'Unknown trade type "{trade.trade_type}" encountered')
 
-        return True, prev_time
-
     def get_calculated_asset_amount(self, asset: Asset) -> Optional[FVal]:
         """Get the amount of asset accounting has calculated we should have after
         the history has been processed
@@ -565,7 +729,4 @@ class Accountant():
         if asset not in self.events.events:
             return None
 
-        amount = FVal(0)
-        for buy_event in self.events.events[asset].buys:
-            amount += buy_event.amount
-        return amount
+        return self.events.running_buy_total.get(asset, ZERO)
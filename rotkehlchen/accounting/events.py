@@ -1,5 +1,6 @@
 import logging
-from typing import Dict, Optional, Tuple
+from collections import defaultdict
+from typing import DefaultDict, Dict, Optional, Tuple
 
 from rotkehlchen.accounting.structures import DefiEvent
 from rotkehlchen.assets.asset import Asset
@@ -10,8 +11,9 @@ from rotkehlchen.errors import NoPriceForGivenTimestamp, PriceQueryUnsupportedAs
 from rotkehlchen.exchanges.data_structures import BuyEvent, Events, MarginPosition, SellEvent
 from rotkehlchen.fval import FVal
 from rotkehlchen.history import PriceHistorian
+from rotkehlchen.history.price import PriceQueryError
 from rotkehlchen.logging import RotkehlchenLogsAdapter
-from rotkehlchen.typing import Fee, Location, Timestamp
+from rotkehlchen.typing import Fee, Location, Price, Timestamp
 from rotkehlchen.utils.misc import taxable_gain_for_sell, timestamp_to_date, ts_now
 
 logger = logging.getLogger(__name__)
@@ -22,8 +24,16 @@ class TaxableEvents():
 
     def __init__(self, csv_exporter: CSVExporter, profit_currency: Asset) -> None:
         self.events: Dict[Asset, Events] = {}
+        # The sum of the amounts of all the remaining buy events of each asset
+        self.running_buy_total: DefaultDict[Asset, FVal] = defaultdict(FVal)
+        # Prices in profit currency prefetched at the start of history processing
+        self.price_cache: Dict[Tuple[Asset, Timestamp], Price] = {}
+        # Errors of the prices that failed to be prefetched, raised again when asked for
+        self.price_errors: Dict[Tuple[Asset, Timestamp], PriceQueryError] = {}
         self.csv_exporter = csv_exporter
         self.profit_currency = profit_currency
+        # Keep the singleton around instead of looking it up for every price query
+        self.price_historian = PriceHistorian()
 
         # If this flag is True when your asset is being forcefully sold as a
         # loan/margin settlement then profit/loss is also calculated before the entire
@@ -36,6 +46,9 @@ class TaxableEvents():
 
     def reset(self, start_ts: Timestamp, end_ts: Timestamp) -> None:
         self.events = {}
+        self.running_buy_total = defaultdict(FVal)
+        self.price_cache = {}
+        self.price_errors = {}
         self.query_start_ts = start_ts
         self.query_end_ts = end_ts
         self.general_trade_profit_loss = ZERO
@@ -106,14 +119,22 @@ class TaxableEvents():
         or with reading the response returned by the server
         """
         if asset == self.profit_currency:
-            rate = FVal(1)
-        else:
-            rate = PriceHistorian().query_historical_price(
-                from_asset=asset,
-                to_asset=self.profit_currency,
-                timestamp=timestamp,
-            )
-        return rate
+            return FVal(1)
+
+        rate = self.price_cache.get((asset, timestamp))
+        if rate is not None:
+            return rate
+
+        error = self.price_errors.get((asset, timestamp))
+        if error is not None:
+            # The oracles already failed for this price, don't ask them a second time
+            raise error
+
+        return self.price_historian.query_historical_price(
+            from_asset=asset,
+            to_asset=self.profit_currency,
+            timestamp=timestamp,
+        )
 
     def reduce_asset_amount(self, asset: Asset, amount: FVal) -> bool:
         """Searches all buy events for asset and reduces them by amount
@@ -145,8 +166,11 @@ class TaxableEvents():
         # and modify the amount of the buy where we stopped if there is one
         if remaining_amount_from_last_buy != FVal('-1'):
             self.events[asset].buys[0].amount = remaining_amount_from_last_buy
-        elif remaining_amount != ZERO:
-            return False
+            self.running_buy_total[asset] -= amount
+        else:
+            self.running_buy_total[asset] -= amount - remaining_amount
+            if remaining_amount != ZERO:
+                return False
 
         return True
 
@@ -356,6 +380,7 @@ class TaxableEvents():
                 fee_rate=fee_in_profit_currency / bought_amount,
             ),
         )
+        self.running_buy_total[bought_asset] += bought_amount
         log.debug(
             'Buy Event',
             sensitive_log=True,
@@ -605,7 +630,9 @@ class TaxableEvents():
                     total_fee_in_profit_currency=total_fee_in_profit_currency,
                     timestamp=timestamp,
                 )
-            else:
+            elif self.csv_exporter.create_csv:
+                # The rate of the receiving asset is only needed for the CSV row so
+                # don't query for it at all if no CSV is going to be created
                 assert receiving_asset, 'Here receiving asset should have a value'
                 self.csv_exporter.add_sell(
                     location=location,
@@ -734,7 +761,11 @@ class TaxableEvents():
         # and modify the amount of the buy where we stopped if there is one
         if remaining_amount_from_last_buy != FVal('-1'):
             self.events[selling_asset].buys[0].amount = remaining_amount_from_last_buy
-        elif remaining_sold_amount != ZERO:
+            self.running_buy_total[selling_asset] -= selling_amount
+            return taxable_amount, taxable_bought_cost, taxfree_bought_cost
+
+        self.running_buy_total[selling_asset] -= selling_amount - remaining_sold_amount
+        if remaining_sold_amount != ZERO:
             # if we still have sold amount but no buys to satisfy it then we only
             # found buys to partially satisfy the sell
             adjusted_amount = selling_amount - taxfree_amount
@@ -787,6 +818,7 @@ class TaxableEvents():
                 fee_rate=ZERO,
             ),
         )
+        self.running_buy_total[gained_asset] += net_gain_amount
         # count profits if we are inside the query period
         if timestamp >= self.query_start_ts:
             log.debug(
@@ -843,6 +875,7 @@ class TaxableEvents():
                     fee_rate=ZERO,
                 ),
             )
+            self.running_buy_total[margin.pl_currency] += margin.profit_loss
         elif margin.profit_loss < 0:
             result = self.reduce_asset_amount(
                 asset=margin.pl_currency,
@@ -1104,7 +1104,7 @@ class RestAPI():
 
     @require_loggedin_user()
     def export_processed_history_csv(self, directory_path: Path) -> Response:
-        if len(self.rotkehlchen.accountant.csvexporter.all_events_csv) == 0:
+        if len(self.rotkehlchen.accountant.csvexporter.all_events) == 0:
             result_dict = wrap_in_fail_result('No history processed in order to perform an export')
             return api_response(result_dict, status_code=HTTPStatus.CONFLICT)
 
@@ -1119,7 +1119,7 @@ class RestAPI():
 
     @require_loggedin_user()
     def download_processed_history_csv(self) -> Response:
-        if len(self.rotkehlchen.accountant.csvexporter.all_events_csv) == 0:
+        if len(self.rotkehlchen.accountant.csvexporter.all_events) == 0:
             result_dict = wrap_in_fail_result('No history processed in order to perform an export')
             return api_response(result_dict, status_code=HTTPStatus.CONFLICT)
 
@@ -254,6 +254,8 @@ class Asset():
         return hash(self.identifier)
 
     def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
         if other is None:
             return False
 
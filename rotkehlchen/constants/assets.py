@@ -41,6 +41,7 @@ A_BSV = Asset('BSV')
 A_ETH = Asset(S_ETH)
 A_ETH2 = Asset('ETH2')
 A_ETC = Asset('ETC')
+A_KFEE = Asset('KFEE')
 A_BAT = EthereumToken('BAT')
 A_DAI = EthereumToken('DAI')
 A_SAI = EthereumToken('SAI')
@@ -15,6 +15,8 @@ EV_DEFI = EventType('defi_event')
 
 ZERO = FVal(0)
 ONE = FVal(1)
+# Amount of wei in one ETH
+WEI_DIVISOR = FVal(10 ** 18)
 
 
 # API URLS
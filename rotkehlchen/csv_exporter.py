@@ -4,7 +4,7 @@ from zipfile import ZipFile
 
 import logging
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from rotkehlchen.accounting.structures import DefiEvent
 from rotkehlchen.assets.asset import Asset
@@ -39,20 +39,35 @@ FILENAME_DEFI_EVENTS_CSV = 'defi_events.csv'
 FILENAME_ALL_CSV = 'all_events.csv'
 
 
-def _dict_to_csv_file(path: Path, dictionary_list: List) -> None:
-    """Takes a filepath and a list of dictionaries representing the rows and writes them
-    into the file as a CSV"""
-    if len(dictionary_list) == 0:
+def _dict_to_csv_file(path: Path, dictionary_list: Iterable[Dict[str, Any]]) -> None:
+    """Takes a filepath and an iterable of dictionaries representing the rows and
+    writes them into the file as a CSV"""
+    rows = iter(dictionary_list)
+    first_row = next(rows, None)
+    if first_row is None:
         log.debug('Skipping writting empty CSV for {}'.format(path))
         return
 
     with open(path, 'w') as f:
-        w = csv.DictWriter(f, dictionary_list[0].keys())
+        w = csv.DictWriter(f, first_row.keys())
         w.writeheader()
-        for dic in dictionary_list:
+        w.writerow(first_row)
+        for dic in rows:
             w.writerow(dic)
 
 
+def _net_profit_or_loss_csv_formula(event_type: EventType, row: int) -> str:
+    """Returns the spreadsheet formula of the net profit/loss of an all events CSV row"""
+    if event_type == EV_BUY:
+        return '0'  # no profit by buying
+    if event_type == EV_SELL:
+        return '=IF(E{}=0,0,L{}-M{})'.format(row, row, row)
+    if event_type in (EV_TX_GAS_COST, EV_ASSET_MOVE, EV_LOAN_SETTLE):
+        return '=-K{}'.format(row)
+    # else can only be one of EV_INTEREST_PAYMENT, EV_MARGIN_CLOSE, EV_DEFI
+    return '=L{}'.format(row)
+
+
 class CSVExporter():
 
     def __init__(
@@ -77,7 +92,6 @@ class CSVExporter():
             self.margin_positions_csv: List[Dict[str, Any]] = []
             self.loan_settlements_csv: List[Dict[str, Any]] = []
             self.defi_events_csv: List[Dict[str, Any]] = []
-            self.all_events_csv: List[Dict[str, Any]] = []
             self.all_events = []
 
     def add_to_allevents(
@@ -95,22 +109,17 @@ class CSVExporter():
             taxable_amount: FVal = ZERO,
             taxable_bought_cost: FVal = ZERO,
     ) -> None:
-        row = len(self.all_events_csv) + 2
         if event_type == EV_BUY:
-            net_profit_or_loss = FVal(0)  # no profit by buying
-            net_profit_or_loss_csv = '0'
+            net_profit_or_loss = ZERO  # no profit by buying
         elif event_type == EV_SELL:
             if taxable_amount == 0:
-                net_profit_or_loss = FVal(0)
+                net_profit_or_loss = ZERO
             else:
                 net_profit_or_loss = taxable_received_in_profit_currency - taxable_bought_cost
-            net_profit_or_loss_csv = '=IF(E{}=0,0,L{}-M{})'.format(row, row, row)
         elif event_type in (EV_TX_GAS_COST, EV_ASSET_MOVE, EV_LOAN_SETTLE):
             net_profit_or_loss = paid_in_profit_currency
-            net_profit_or_loss_csv = '=-K{}'.format(row)
         elif event_type in (EV_INTEREST_PAYMENT, EV_MARGIN_CLOSE, EV_DEFI):
             net_profit_or_loss = taxable_received_in_profit_currency
-            net_profit_or_loss_csv = '=L{}'.format(row)
         else:
             raise ValueError('Illegal event type "{}" at add_to_allevents'.format(event_type))
 
@@ -137,18 +146,30 @@ class CSVExporter():
         }
         log.debug('csv event', **make_sensitive(entry))
         self.all_events.append(entry)
-        new_entry = entry.copy()
-        new_entry['net_profit_or_loss'] = net_profit_or_loss_csv
-        new_entry['time'] = timestamp_to_date(timestamp, formatstr='%d/%m/%Y %H:%M:%S')
-        new_entry[f'paid_in_{self.profit_currency.identifier}'] = paid_in_profit_currency
-        key = f'taxable_received_in_{self.profit_currency.identifier}'
-        new_entry[key] = taxable_received_in_profit_currency
-        key = f'taxable_bought_cost_in_{self.profit_currency.identifier}'
-        new_entry[key] = taxable_bought_cost
-        del new_entry['paid_in_profit_currency']
-        del new_entry['taxable_received_in_profit_currency']
-        del new_entry['taxable_bought_cost_in_profit_currency']
-        self.all_events_csv.append(new_entry)
+
+    def iter_all_events_csv(self) -> Iterator[Dict[str, Any]]:
+        """Yields the rows of the all events CSV
+
+        The rows are derived from the all events entries only when the CSV is
+        written so that we don't keep a second copy of every event in memory
+        """
+        paid_key = f'paid_in_{self.profit_currency.identifier}'
+        taxable_received_key = f'taxable_received_in_{self.profit_currency.identifier}'
+        taxable_bought_cost_key = f'taxable_bought_cost_in_{self.profit_currency.identifier}'
+        for idx, entry in enumerate(self.all_events):
+            new_entry = entry.copy()
+            new_entry['net_profit_or_loss'] = _net_profit_or_loss_csv_formula(
+                event_type=entry['type'],
+                row=idx + 2,
+            )
+            new_entry['time'] = timestamp_to_date(entry['time'], formatstr='%d/%m/%Y %H:%M:%S')
+            new_entry[paid_key] = entry['paid_in_profit_currency']
+            new_entry[taxable_received_key] = entry['taxable_received_in_profit_currency']
+            new_entry[taxable_bought_cost_key] = entry['taxable_bought_cost_in_profit_currency']
+            del new_entry['paid_in_profit_currency']
+            del new_entry['taxable_received_in_profit_currency']
+            del new_entry['taxable_bought_cost_in_profit_currency']
+            yield new_entry
 
     def add_buy(
             self,
@@ -179,8 +200,8 @@ class CSVExporter():
             'exchanged_for': paid_with_asset.identifier,
             exchange_rate_key: paid_with_asset_rate,
             'taxable_bought_cost_in_{}'.format(self.profit_currency.identifier): 'not applicable',
-            'taxable_gain_in_{}'.format(self.profit_currency.identifier): FVal(0),
-            'taxable_profit_loss_in_{}'.format(self.profit_currency.identifier): FVal(0),
+            'taxable_gain_in_{}'.format(self.profit_currency.identifier): ZERO,
+            'taxable_profit_loss_in_{}'.format(self.profit_currency.identifier): ZERO,
             'time': timestamp_to_date(timestamp, formatstr='%d/%m/%Y %H:%M:%S'),
             'is_virtual': is_virtual,
         })
@@ -192,7 +213,7 @@ class CSVExporter():
             paid_in_asset=cost,
             received_asset=bought_asset,
             received_in_asset=amount,
-            taxable_received_in_profit_currency=FVal(0),
+            taxable_received_in_profit_currency=ZERO,
             timestamp=timestamp,
             is_virtual=is_virtual,
         )
@@ -220,7 +241,7 @@ class CSVExporter():
             EmptyStr('') if receiving_asset is None else receiving_asset
         )
         exported_receiving_asset = '' if receiving_asset is None else receiving_asset.identifier
-        processed_receiving_amount = FVal(0) if not receiving_amount else receiving_amount
+        processed_receiving_amount = ZERO if not receiving_amount else receiving_amount
         exchange_rate_key = f'exchanged_asset_{self.profit_currency.identifier}_exchange_rate'
         taxable_profit_received = taxable_gain_for_sell(
             taxable_amount=taxable_amount,
@@ -294,8 +315,8 @@ class CSVExporter():
             paid_asset=asset,
             paid_in_asset=amount,
             received_asset=S_EMPTYSTR,
-            received_in_asset=FVal(0),
-            taxable_received_in_profit_currency=FVal(0),
+            received_in_asset=ZERO,
+            taxable_received_in_profit_currency=ZERO,
             timestamp=timestamp,
         )
 
@@ -324,9 +345,9 @@ class CSVExporter():
         self.add_to_allevents(
             location=location,
             event_type=EV_INTEREST_PAYMENT,
-            paid_in_profit_currency=FVal(0),
+            paid_in_profit_currency=ZERO,
             paid_asset=S_EMPTYSTR,
-            paid_in_asset=FVal(0),
+            paid_in_asset=ZERO,
             received_asset=gained_asset,
             received_in_asset=gained_amount,
             taxable_received_in_profit_currency=gain_in_profit_currency,
@@ -359,9 +380,9 @@ class CSVExporter():
         self.add_to_allevents(
             event_type=EV_MARGIN_CLOSE,
             location=location,
-            paid_in_profit_currency=FVal(0),
+            paid_in_profit_currency=ZERO,
             paid_asset=S_EMPTYSTR,
-            paid_in_asset=FVal(0),
+            paid_in_asset=ZERO,
             received_asset=gain_loss_asset,
             received_in_asset=gain_loss_amount,
             taxable_received_in_profit_currency=gain_loss_in_profit_currency,
@@ -395,8 +416,8 @@ class CSVExporter():
             paid_asset=asset,
             paid_in_asset=fee,
             received_asset=S_EMPTYSTR,
-            received_in_asset=FVal(0),
-            taxable_received_in_profit_currency=FVal(0),
+            received_in_asset=ZERO,
+            taxable_received_in_profit_currency=ZERO,
             timestamp=timestamp,
         )
 
@@ -423,8 +444,8 @@ class CSVExporter():
             paid_asset=A_ETH,
             paid_in_asset=eth_burned_as_gas,
             received_asset=S_EMPTYSTR,
-            received_in_asset=FVal(0),
-            taxable_received_in_profit_currency=FVal(0),
+            received_in_asset=ZERO,
+            taxable_received_in_profit_currency=ZERO,
             timestamp=timestamp,
         )
 
@@ -505,7 +526,7 @@ class CSVExporter():
             )
             _dict_to_csv_file(
                 dirpath / FILENAME_ALL_CSV,
-                self.all_events_csv,
+                self.iter_all_events_csv(),
             )
         except PermissionError as e:
             return False, str(e)
@@ -2,12 +2,14 @@ import glob
 import logging
 import os
 import re
+from collections import defaultdict
 from json.decoder import JSONDecodeError
 from pathlib import Path
-from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, NewType, Optional
+from typing import Any, DefaultDict, Dict, Iterable, Iterator, List, NamedTuple, NewType, Optional
 
 import gevent
 import requests
+from gevent.lock import Semaphore
 from typing_extensions import Literal
 
 from rotkehlchen.assets.asset import Asset
@@ -220,6 +222,7 @@ class Cryptocompare(ExternalServiceWithApiKey):
         self.data_directory = data_directory
         self.price_history: Dict[PairCacheKey, PriceHistoryData] = {}
         self.price_history_file: Dict[PairCacheKey, Path] = {}
+        self._pair_locks: DefaultDict[PairCacheKey, Semaphore] = defaultdict(Semaphore)
         self.session = requests.session()
         self.session.headers.update({'User-Agent': 'rotkehlchen'})
 
@@ -538,6 +541,25 @@ class Cryptocompare(ExternalServiceWithApiKey):
         or with reading the response returned by the server
         - May raise UnsupportedAsset if from/to asset is not supported by cryptocompare
         """
+        cache_key = PairCacheKey(from_asset.identifier + '_' + to_asset.identifier)
+        # Concurrent price queries can need the history of the same pair. Let only one
+        # of them retrieve and save it while the others wait to read it from the cache
+        with self._pair_locks[cache_key]:
+            return self._get_historical_data(
+                from_asset=from_asset,
+                to_asset=to_asset,
+                timestamp=timestamp,
+                historical_data_start=historical_data_start,
+            )
+
+    def _get_historical_data(
+            self,
+            from_asset: Asset,
+            to_asset: Asset,
+            timestamp: Timestamp,
+            historical_data_start: Timestamp,
+    ) -> List[PriceHistoryEntry]:
+        """Same as get_historical_data but without holding the lock of the pair"""
         log.debug(
             'Retrieving historical price data from cryptocompare',
             from_asset=from_asset,
@@ -1,17 +1,21 @@
 import logging
 from pathlib import Path
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+from gevent.lock import Semaphore
+from gevent.pool import Pool
 
 from rotkehlchen.assets.asset import Asset
 from rotkehlchen.constants.assets import A_USD
 from rotkehlchen.constants.misc import ZERO
-from rotkehlchen.errors import NoPriceForGivenTimestamp, RemoteError
+from rotkehlchen.errors import NoPriceForGivenTimestamp, PriceQueryUnsupportedAsset, RemoteError
 from rotkehlchen.fval import FVal
+from rotkehlchen.history.price_cache import PriceCache
 from rotkehlchen.inquirer import Inquirer
 from rotkehlchen.logging import RotkehlchenLogsAdapter
 from rotkehlchen.typing import Price, Timestamp
 from rotkehlchen.user_messages import MessagesAggregator
-from rotkehlchen.utils.misc import create_timestamp
+from rotkehlchen.utils.misc import create_timestamp, ts_now
 
 if TYPE_CHECKING:
     from rotkehlchen.externalapis.cryptocompare import Cryptocompare
@@ -19,6 +23,18 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 log = RotkehlchenLogsAdapter(logger)
 
+# Prices younger than this many seconds may still change so they are not persisted
+PRICE_CACHE_MIN_AGE = 3600
+# How many assets to query the historical prices of concurrently in bulk queries
+BULK_PRICE_QUERY_POOL_SIZE = 10
+
+PriceQueryError = Union[NoPriceForGivenTimestamp, PriceQueryUnsupportedAsset, RemoteError]
+# The found prices and the errors of the failed queries, per (from_asset, timestamp)
+BulkPriceQueryResult = Tuple[
+    Dict[Tuple[Asset, Timestamp], Price],
+    Dict[Tuple[Asset, Timestamp], PriceQueryError],
+]
+
 
 def query_usd_price_or_use_default(
         asset: Asset,
@@ -68,6 +84,8 @@ class PriceHistorian():
     __instance: Optional['PriceHistorian'] = None
     _historical_data_start: Timestamp
     _cryptocompare: 'Cryptocompare'
+    _price_cache: Optional[PriceCache]
+    _forex_lock = Semaphore()
 
     def __new__(
             cls,
@@ -89,6 +107,7 @@ class PriceHistorian():
             formatstr="%d/%m/%Y",
         )
         PriceHistorian._cryptocompare = cryptocompare
+        PriceHistorian._price_cache = PriceCache(data_directory)
 
         return PriceHistorian.__instance
 
@@ -122,13 +141,29 @@ class PriceHistorian():
         if from_asset == to_asset:
             return Price(FVal('1'))
 
+        return PriceHistorian()._query_oracles(from_asset, to_asset, timestamp)
+
+    @staticmethod
+    def _query_oracles(from_asset: Asset, to_asset: Asset, timestamp: Timestamp) -> Price:
+        """Query the price oracles for the historical price of `from_asset` in `to_asset`
+
+        May raise:
+        - PriceQueryUnsupportedAsset if from/to asset is missing from price oracles
+        - NoPriceForGivenTimestamp if we can't find a price for the asset in the given
+        timestamp from the external service.
+        - RemoteError if there is a problem reaching the price oracle server
+        or with reading the response returned by the server
+        """
         if from_asset.is_fiat() and to_asset.is_fiat():
             # if we are querying historical forex data then try something other than cryptocompare
-            price = Inquirer().query_historical_fiat_exchange_rates(
-                from_fiat_currency=from_asset,
-                to_fiat_currency=to_asset,
-                timestamp=timestamp,
-            )
+            # Concurrent queries ask for the rates of the same dates. Serialize them so
+            # that only the first one of each date reaches the forex API
+            with PriceHistorian._forex_lock:
+                price = Inquirer().query_historical_fiat_exchange_rates(
+                    from_fiat_currency=from_asset,
+                    to_fiat_currency=to_asset,
+                    timestamp=timestamp,
+                )
             if price is not None:
                 return price
             # else cryptocompare also has historical fiat to fiat data
@@ -140,3 +175,112 @@ class PriceHistorian():
             timestamp=timestamp,
             historical_data_start=instance._historical_data_start,
         )
+
+    @staticmethod
+    def query_historical_prices_bulk(
+            to_asset: Asset,
+            queries: Dict[Asset, List[Timestamp]],
+    ) -> BulkPriceQueryResult:
+        """
+        Query the historical prices of many assets at many timestamps in `to_asset`.
+
+        `queries` maps each `from_asset` to the timestamps at which we want its price.
+        All timestamps of an asset are resolved in one go so that the historical
+        data range of the pair is retrieved from the oracle once and all the
+        remaining points are served from the already cached range. The different
+        assets are queried concurrently. The pairs and forex rates they share, like
+        the BTC fallback or the USD rate of `to_asset`, are still retrieved only once
+        since the queries of each pair and of forex rates are serialized.
+
+        Only this bulk path reads and writes the persistent price cache, with one
+        write per asset. Single point queries, including the ones the oracles make
+        on their own to adjust a price, are answered from the in-memory caches of
+        the oracles and never touch the DB.
+
+        Returns a tuple of two mappings keyed by (from_asset, timestamp). The first
+        has the found prices and the second the error each failed point got, so that
+        callers don't have to query the oracles again only to get the same error.
+        Points in neither mapping were not queried, because an earlier point of the
+        same asset could not reach the oracle.
+        """
+        pool = Pool(size=BULK_PRICE_QUERY_POOL_SIZE)
+        results = pool.map(
+            lambda entry: PriceHistorian._query_asset_prices(
+                from_asset=entry[0],
+                to_asset=to_asset,
+                timestamps=entry[1],
+            ),
+            queries.items(),
+        )
+        prices: Dict[Tuple[Asset, Timestamp], Price] = {}
+        errors: Dict[Tuple[Asset, Timestamp], PriceQueryError] = {}
+        for asset_prices, asset_errors in results:
+            prices.update(asset_prices)
+            errors.update(asset_errors)
+
+        return prices, errors
+
+    @staticmethod
+    def _query_asset_prices(
+            from_asset: Asset,
+            to_asset: Asset,
+            timestamps: List[Timestamp],
+    ) -> BulkPriceQueryResult:
+        """Query the prices of a single asset at the given timestamps
+
+        Points already in the persistent price cache are not queried again and
+        the newly queried ones are added to it in one go at the end.
+        Points that can't be priced get their error recorded. If the asset is not
+        supported then that is the error of all the remaining points too. If the
+        oracle can't be reached then the remaining points are not queried at all.
+        """
+        prices: Dict[Tuple[Asset, Timestamp], Price] = {}
+        errors: Dict[Tuple[Asset, Timestamp], PriceQueryError] = {}
+        if from_asset == to_asset:
+            for timestamp in timestamps:
+                prices[(from_asset, timestamp)] = Price(FVal('1'))
+            return prices, errors
+
+        to_query = sorted(set(timestamps))
+        price_cache = PriceHistorian()._price_cache
+        if price_cache is not None:
+            cached, to_query = price_cache.gap_fill(from_asset, to_asset, to_query)
+            for timestamp, price in cached.items():
+                prices[(from_asset, timestamp)] = price
+
+        instance = PriceHistorian()
+        persist_before = ts_now() - PRICE_CACHE_MIN_AGE
+        to_persist: List[Tuple[Timestamp, Price]] = []
+        for idx, timestamp in enumerate(to_query):
+            try:
+                price = instance._query_oracles(from_asset, to_asset, timestamp)
+            except NoPriceForGivenTimestamp as e:
+                errors[(from_asset, timestamp)] = e
+            except PriceQueryUnsupportedAsset as e:
+                log.debug(
+                    'Stopping bulk historical price query',
+                    from_asset=from_asset,
+                    to_asset=to_asset,
+                    error=str(e),
+                )
+                for unsupported_timestamp in to_query[idx:]:
+                    errors[(from_asset, unsupported_timestamp)] = e
+                break
+            except RemoteError as e:
+                log.debug(
+                    'Stopping bulk historical price query',
+                    from_asset=from_asset,
+                    to_asset=to_asset,
+                    error=str(e),
+                )
+                errors[(from_asset, timestamp)] = e
+                break
+            else:
+                prices[(from_asset, timestamp)] = price
+                if timestamp < persist_before:
+                    to_persist.append((timestamp, price))
+
+        if price_cache is not None:
+            price_cache.add(from_asset, to_asset, to_persist)
+
+        return prices, errors
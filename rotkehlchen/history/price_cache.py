@@ -0,0 +1,100 @@
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+from rotkehlchen.assets.asset import Asset
+from rotkehlchen.errors import DeserializationError
+from rotkehlchen.logging import RotkehlchenLogsAdapter
+from rotkehlchen.serialization.deserialize import deserialize_price
+from rotkehlchen.typing import Price, Timestamp
+
+logger = logging.getLogger(__name__)
+log = RotkehlchenLogsAdapter(logger)
+
+PRICE_CACHE_FILENAME = 'price_cache.db'
+
+DB_CREATE_PRICE_CACHE = """
+CREATE TABLE IF NOT EXISTS price_cache (
+    from_asset VARCHAR[12] NOT NULL,
+    to_asset VARCHAR[12] NOT NULL,
+    timestamp INTEGER NOT NULL,
+    price TEXT NOT NULL,
+    PRIMARY KEY (from_asset, to_asset, timestamp)
+);
+"""
+
+
+class PriceCache():
+    """Persistent cache of historical prices
+
+    It is kept in its own unencrypted sqlite file in the data directory, next to
+    cryptocompare's price history files, and not in the user DB. Prices are the same
+    for all users and can always be queried again, so there is no reason to encrypt
+    them or to have premium sync upload them. Deleting the file purges the cache.
+
+    Historical prices never change once they are in the past so entries
+    of the cache never expire.
+    """
+
+    def __init__(self, data_directory: Path) -> None:
+        self.conn = sqlite3.connect(str(data_directory / PRICE_CACHE_FILENAME))
+        self.conn.executescript(DB_CREATE_PRICE_CACHE)
+
+    def add(
+            self,
+            from_asset: Asset,
+            to_asset: Asset,
+            entries: Sequence[Tuple[Timestamp, Price]],
+    ) -> None:
+        """Saves the given (timestamp, price) entries of the pair in the cache"""
+        if len(entries) == 0:
+            return
+
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            'INSERT OR IGNORE INTO price_cache(from_asset, to_asset, timestamp, price) '
+            'VALUES(?, ?, ?, ?);',
+            [
+                (from_asset.identifier, to_asset.identifier, timestamp, str(price))
+                for timestamp, price in entries
+            ],
+        )
+        self.conn.commit()
+
+    def gap_fill(
+            self,
+            from_asset: Asset,
+            to_asset: Asset,
+            timestamps: List[Timestamp],
+    ) -> Tuple[Dict[Timestamp, Price], List[Timestamp]]:
+        """Looks up the cached prices of the pair for all the given timestamps at once
+
+        Returns a tuple of the prices found in the cache and the sorted list of
+        timestamps for which we have no cached price and need to query for.
+        """
+        if len(timestamps) == 0:
+            return {}, []
+
+        cursor = self.conn.cursor()
+        query = cursor.execute(
+            'SELECT timestamp, price FROM price_cache WHERE from_asset=? AND to_asset=? '
+            'AND timestamp >= ? AND timestamp <= ?;',
+            (from_asset.identifier, to_asset.identifier, min(timestamps), max(timestamps)),
+        )
+        wanted = set(timestamps)
+        cached: Dict[Timestamp, Price] = {}
+        for timestamp, price in query:
+            if timestamp not in wanted:
+                continue
+
+            try:
+                cached[Timestamp(timestamp)] = deserialize_price(price)
+            except DeserializationError as e:
+                log.error(
+                    f'Found invalid cached price for {from_asset.identifier} in '
+                    f'{to_asset.identifier} at {timestamp}: {str(e)}. Ignoring it',
+                )
+
+        missing = sorted(wanted - cached.keys())
+        return cached, missing
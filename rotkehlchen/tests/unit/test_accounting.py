@@ -1,8 +1,10 @@
 import pytest
 
-from rotkehlchen.constants.assets import A_BTC, A_ETH
+from rotkehlchen.accounting.structures import DefiEvent, DefiEventType
+from rotkehlchen.constants.assets import A_BTC, A_DAI, A_ETH, A_EUR, A_KFEE
 from rotkehlchen.exchanges.data_structures import AssetMovement, MarginPosition
 from rotkehlchen.fval import FVal
+from rotkehlchen.history import PriceHistorian
 from rotkehlchen.tests.utils.accounting import accounting_history_process
 from rotkehlchen.tests.utils.constants import A_DASH
 from rotkehlchen.tests.utils.history import prices
@@ -59,6 +61,218 @@ def test_simple_accounting(accountant):
     assert accountant.taxable_trade_pl.is_close("557.5284549025")
 
 
+@pytest.mark.parametrize('mocked_price_queries', [prices])
+def test_prices_are_prefetched(accountant):
+    accounting_history_process(accountant, 1436979735, 1495751688, history1)
+    assert accountant.events.price_cache == {
+        (A_BTC, 1473505138): FVal('556.435'),
+        (A_ETH, 1473505138): FVal('10.36'),
+        (A_BTC, 1475042230): FVal('537.805'),
+        (A_ETH, 1475042230): FVal('11.925'),
+    }
+    assert accountant.events.price_errors == {}
+
+
+@pytest.mark.parametrize('default_mock_price_value', [FVal('1.5')])
+@pytest.mark.parametrize('db_settings', [
+    {'include_crypto2crypto': True},
+    {'include_crypto2crypto': False},
+])
+def test_prefetched_prices_match_the_used_ones(accountant, price_historian):
+    """Test that exactly the prices processing the history asks for are prefetched
+
+    The prefetch repeats the pricing rules of the events so this makes sure that
+    nothing the events need is missed and that nothing extra is queried"""
+    history = [{
+        'timestamp': 1476979735,
+        'pair': 'BTC_EUR',  # fiat quote
+        'trade_type': 'buy',
+        'rate': 578.505,
+        'fee': 0.0012,
+        'fee_currency': 'BTC',
+        'amount': 5,
+        'location': 'kraken',
+    }, {
+        'timestamp': 1477979735,
+        'pair': 'ETH_BTC',  # crypto to crypto
+        'trade_type': 'buy',
+        'rate': 0.015,
+        'fee': 0.1,
+        'fee_currency': 'ETH',
+        'amount': 20,
+        'location': 'poloniex',
+    }, {
+        'timestamp': 1478979735,
+        'pair': 'ETH_BTC',
+        'trade_type': 'sell',
+        'rate': 0.016,
+        'fee': 0.0001,
+        'fee_currency': 'BTC',
+        'amount': 5,
+        'location': 'poloniex',
+    }, {
+        'timestamp': 1479979735,
+        'pair': 'DASH_BTC',
+        'trade_type': 'settlement_buy',
+        'rate': 0.015855,
+        'fee': 0.15,
+        'fee_currency': 'DASH',
+        'amount': 0.5,
+        'location': 'poloniex',
+    }, {
+        'timestamp': 1480979735,
+        'pair': 'ETH_BTC',
+        'trade_type': 'settlement_sell',
+        'rate': 0.016,
+        'fee': 0,
+        'fee_currency': 'BTC',
+        'amount': 2,
+        'location': 'poloniex',
+    }, {
+        'timestamp': 1481979735,
+        'pair': 'BTC_EUR',
+        'trade_type': 'sell',
+        'rate': 780.5,
+        'fee': 0.02,
+        'fee_currency': 'EUR',
+        'amount': 1,
+        'location': 'kraken',
+    }]
+    margin_list = [MarginPosition(
+        location=Location.POLONIEX,
+        open_time=1482438400,
+        close_time=1482629704,
+        profit_loss=FVal('-0.5'),
+        pl_currency=A_BTC,
+        fee=FVal('0.001'),
+        fee_currency=A_BTC,
+        link='1',
+        notes='margin1',
+    )]
+    asset_movements_list = [AssetMovement(
+        # before the start of the period so it should not be accounted for at all
+        location=Location.KRAKEN,
+        category=AssetMovementCategory.WITHDRAWAL,
+        address=None,
+        transaction_id=None,
+        timestamp=Timestamp(1466979735),
+        asset=A_ETH,
+        amount=FVal('10'),
+        fee_asset=A_ETH,
+        fee=Fee(FVal('0.001')),
+        link='krakenid1',
+    ), AssetMovement(
+        location=Location.KRAKEN,
+        category=AssetMovementCategory.DEPOSIT,
+        address=None,
+        transaction_id=None,
+        timestamp=Timestamp(1483979735),
+        asset=A_KFEE,  # KFEE movements are never accounted for
+        amount=FVal('100'),
+        fee_asset=A_ETH,
+        fee=Fee(FVal('0.001')),
+        link='krakenid2',
+    ), AssetMovement(
+        location=Location.POLONIEX,
+        category=AssetMovementCategory.WITHDRAWAL,
+        address='foo',
+        transaction_id='0xfoo',
+        timestamp=Timestamp(1484979735),
+        asset=A_BTC,
+        amount=FVal('0.5'),
+        fee_asset=A_BTC,
+        fee=Fee(FVal('0.00029')),
+        link='poloniexid1',
+    )]
+    eth_tx_list = [EthereumTransaction(
+        timestamp=1485979735,
+        block_number=3458409,
+        tx_hash=DUMMY_HASH,
+        from_address=DUMMY_ADDRESS,
+        to_address=DUMMY_ADDRESS,
+        value=FVal('12323'),
+        gas=FVal('5000000'),
+        gas_price=FVal('2000000000'),
+        gas_used=FVal('1000000'),
+        input_data=DUMMY_HASH,
+        nonce=0,
+    )]
+    defi_events_list = [DefiEvent(
+        timestamp=Timestamp(1486979735),
+        event_type=DefiEventType.DSR_LOAN_GAIN,
+        asset=A_DAI,
+        amount=FVal('2'),
+    )]
+
+    used_prices = set()
+    get_rate_in_profit_currency = accountant.events.get_rate_in_profit_currency
+
+    def recording_get_rate(asset, timestamp):
+        if asset != accountant.events.profit_currency:
+            used_prices.add((asset, timestamp))
+        return get_rate_in_profit_currency(asset, timestamp)
+
+    def strict_price_query(from_asset, to_asset, timestamp):
+        raise AssertionError(f'The {from_asset} price at {timestamp} was not prefetched')
+
+    accountant.events.get_rate_in_profit_currency = recording_get_rate
+    # Bulk queries go to the mocked oracles but no single query should happen after them
+    price_historian.query_historical_price = strict_price_query
+    accounting_history_process(
+        accountant,
+        start_ts=1476979735,
+        end_ts=1495751688,
+        history_list=history,
+        margin_list=margin_list,
+        asset_movements_list=asset_movements_list,
+        eth_transaction_list=eth_tx_list,
+        defi_events_list=defi_events_list,
+    )
+    assert accountant.events.price_errors == {}
+    assert set(accountant.events.price_cache.keys()) == used_prices
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+@pytest.mark.parametrize('should_mock_price_queries', [False])
+def test_prefetched_prices_are_saved_once_per_asset(accountant, cryptocompare):
+    """Test that prefetching EUR prices commits to the price cache once per asset,
+    even though the oracle itself queries more prices for each of the points"""
+    def mock_cryptocompare_query(
+            from_asset,
+            to_asset,
+            timestamp,
+            historical_data_start,  # pylint: disable=unused-argument
+    ):
+        if A_BTC in (from_asset, to_asset):
+            return FVal(timestamp % 1000)
+        # Other pairs go through BTC, like the cryptocompare fallback does
+        from_btc = PriceHistorian().query_historical_price(from_asset, A_BTC, timestamp)
+        btc_to = PriceHistorian().query_historical_price(A_BTC, to_asset, timestamp)
+        return from_btc * btc_to
+
+    cryptocompare.query_historical_price = mock_cryptocompare_query
+    statements = []
+
+    def trace_statement(statement):
+        statements.append(statement)
+
+    price_cache = accountant.price_historian._price_cache
+    price_cache.conn.set_trace_callback(trace_statement)
+    accounting_history_process(accountant, 1436979735, 1495751688, history1)
+
+    assert set(accountant.events.price_cache.keys()) == {
+        (A_BTC, 1473505138),
+        (A_ETH, 1473505138),
+        (A_BTC, 1475042230),
+        (A_ETH, 1475042230),
+    }
+    assert statements.count('COMMIT') == 2
+    assert len(price_cache.gap_fill(A_BTC, A_EUR, [1473505138, 1475042230])[0]) == 2
+    assert len(price_cache.gap_fill(A_ETH, A_EUR, [1473505138, 1475042230])[0]) == 2
+    # The prices the oracle queried on its own are not saved
+    assert price_cache.gap_fill(A_ETH, A_BTC, [1473505138, 1475042230])[0] == {}
+
+
 @pytest.mark.parametrize('mocked_price_queries', [prices])
 def test_selling_crypto_bought_with_crypto(accountant):
     history = [{
@@ -1,5 +1,7 @@
 import pytest
 
+from rotkehlchen.constants.assets import A_BTC, A_EUR
+from rotkehlchen.errors import NoPriceForGivenTimestamp
 from rotkehlchen.exchanges.data_structures import BuyEvent, Events
 from rotkehlchen.fval import FVal
 
@@ -357,3 +359,14 @@ def test_reduce_asset_amount_more_that_bought(accountant):
 
     assert not accountant.events.reduce_asset_amount(asset, FVal(3))
     assert (len(accountant.events.events[asset].buys)) == 0, 'all buys should be used'
+
+
+def test_failed_prefetched_price_is_not_queried_again(accountant):
+    """Test that a price whose prefetching failed raises the stored error
+
+    No prices are mocked so asking the historian would fail with an AssertionError
+    """
+    error = NoPriceForGivenTimestamp(A_BTC, A_EUR, '08/11/2015')
+    accountant.events.price_errors[(A_BTC, 1446979735)] = error
+    with pytest.raises(NoPriceForGivenTimestamp):
+        accountant.events.get_rate_in_profit_currency(A_BTC, 1446979735)
@@ -1,8 +1,13 @@
-from rotkehlchen.constants.assets import A_ETH
+import pytest
+
+from rotkehlchen.constants.assets import A_BTC, A_ETH, A_EUR, A_USD
+from rotkehlchen.errors import NoPriceForGivenTimestamp, PriceQueryUnsupportedAsset, RemoteError
 from rotkehlchen.exchanges.data_structures import Trade
 from rotkehlchen.fval import FVal
+from rotkehlchen.history.price_cache import PriceCache
 from rotkehlchen.history.trades import limit_trade_list_to_period
 from rotkehlchen.typing import Location, TradeType
+from rotkehlchen.utils.misc import ts_now
 
 
 def test_limit_trade_list_to_period():
@@ -57,3 +62,135 @@ def test_limit_trade_list_to_period():
     assert limit_trade_list_to_period(full_list, 1459427707, 1459427707) == [trade1]
     assert limit_trade_list_to_period(full_list, 1469427707, 1469427707) == [trade2]
     assert limit_trade_list_to_period(full_list, 1479427707, 1479427707) == [trade3]
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_price_cache(data_dir):
+    price_cache = PriceCache(data_dir)
+    assert price_cache.gap_fill(A_ETH, A_EUR, [1459427707]) == ({}, [1459427707])
+
+    price_cache.add(A_ETH, A_EUR, [(1459427707, FVal('10.5')), (1469427707, FVal('9.25'))])
+    price_cache.add(A_BTC, A_EUR, [(1459427707, FVal('380'))])
+    # Re-adding an existing entry should be ignored
+    price_cache.add(A_ETH, A_EUR, [(1459427707, FVal('1'))])
+    assert price_cache.gap_fill(A_EUR, A_ETH, [1459427707]) == ({}, [1459427707])
+
+    cached, missing = price_cache.gap_fill(
+        A_ETH,
+        A_EUR,
+        [1469427707, 1449427707, 1459427707, 1479427707],
+    )
+    assert cached == {1459427707: FVal('10.5'), 1469427707: FVal('9.25')}
+    assert missing == [1449427707, 1479427707]
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+@pytest.mark.parametrize('should_mock_price_queries', [False])
+def test_query_historical_prices_bulk_records_errors(price_historian):
+    """Test that the bulk query returns the error of each failed point and does not
+    query again the points of an asset after the oracle could not be reached"""
+    queried = []
+
+    def mock_query_oracles(from_asset, to_asset, timestamp):
+        queried.append((from_asset, timestamp))
+        if from_asset == A_ETH and timestamp == 1459427707:
+            raise NoPriceForGivenTimestamp(from_asset, to_asset, str(timestamp))
+        if from_asset == A_EUR:
+            raise PriceQueryUnsupportedAsset(from_asset.identifier)
+        if from_asset == A_BTC and timestamp == 1469427707:
+            raise RemoteError('oracle is down')
+        return FVal(timestamp)
+
+    price_historian._query_oracles = mock_query_oracles
+    prices, errors = price_historian.query_historical_prices_bulk(
+        to_asset=A_USD,
+        queries={
+            A_ETH: [1469427707, 1459427707, 1469427707],
+            A_EUR: [1459427707, 1469427707],
+            A_BTC: [1459427707, 1469427707, 1479427707],
+        },
+    )
+    assert prices == {
+        (A_ETH, 1469427707): FVal(1469427707),
+        (A_BTC, 1459427707): FVal(1459427707),
+    }
+    assert set(errors.keys()) == {
+        (A_ETH, 1459427707),
+        (A_EUR, 1459427707),
+        (A_EUR, 1469427707),
+        (A_BTC, 1469427707),
+    }
+    assert isinstance(errors[(A_ETH, 1459427707)], NoPriceForGivenTimestamp)
+    assert isinstance(errors[(A_EUR, 1469427707)], PriceQueryUnsupportedAsset)
+    assert isinstance(errors[(A_BTC, 1469427707)], RemoteError)
+    # Every point is queried at most once and nothing after an unsupported asset
+    # or an unreachable oracle
+    assert sorted(queried) == sorted([
+        (A_ETH, 1459427707),
+        (A_ETH, 1469427707),
+        (A_EUR, 1459427707),
+        (A_BTC, 1459427707),
+        (A_BTC, 1469427707),
+    ])
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+@pytest.mark.parametrize('should_mock_price_queries', [False])
+def test_price_historian_uses_price_cache(price_historian, data_dir):
+    """Test that bulk queries read and write the persistent price cache, that they
+    don't persist prices close to now and that single queries don't touch it"""
+    queried = []
+
+    def mock_query_oracles(from_asset, to_asset, timestamp):  # pylint: disable=unused-argument
+        queried.append((from_asset, timestamp))
+        return FVal(timestamp)
+
+    price_historian._query_oracles = mock_query_oracles
+    price_cache = PriceCache(data_dir)
+    # Single queries always go to the oracles and are not saved
+    assert price_historian.query_historical_price(A_ETH, A_EUR, 1459427707) == 1459427707
+    assert price_historian.query_historical_price(A_ETH, A_EUR, 1459427707) == 1459427707
+    assert queried == [(A_ETH, 1459427707), (A_ETH, 1459427707)]
+    assert price_cache.gap_fill(A_ETH, A_EUR, [1459427707]) == ({}, [1459427707])
+
+    # A bulk query saves all of the new prices with a single add, apart from
+    # the ones of the last hour which may still change
+    now = ts_now()
+    queried.clear()
+    add_calls = []
+    historian_cache = price_historian._price_cache
+    original_add = historian_cache.add
+
+    def counting_add(from_asset, to_asset, entries):
+        add_calls.append(list(entries))
+        original_add(from_asset, to_asset, entries)
+
+    historian_cache.add = counting_add
+    prices, errors = price_historian.query_historical_prices_bulk(
+        to_asset=A_EUR,
+        queries={A_ETH: [1469427707, 1459427707, now]},
+    )
+    assert prices == {
+        (A_ETH, 1459427707): FVal(1459427707),
+        (A_ETH, 1469427707): FVal(1469427707),
+        (A_ETH, now): FVal(now),
+    }
+    assert errors == {}
+    assert queried == [(A_ETH, 1459427707), (A_ETH, 1469427707), (A_ETH, now)]
+    assert add_calls == [[(1459427707, FVal(1459427707)), (1469427707, FVal(1469427707))]]
+
+    # and the next bulk query only asks the oracles for the points missing from the cache
+    queried.clear()
+    add_calls.clear()
+    prices, errors = price_historian.query_historical_prices_bulk(
+        to_asset=A_EUR,
+        queries={A_ETH: [1469427707, 1459427707, 1479427707]},
+    )
+    assert prices == {
+        (A_ETH, 1459427707): FVal(1459427707),
+        (A_ETH, 1469427707): FVal(1469427707),
+        (A_ETH, 1479427707): FVal(1479427707),
+    }
+    assert errors == {}
+    assert queried == [(A_ETH, 1479427707)]
+    assert add_calls == [[(1479427707, FVal(1479427707))]]
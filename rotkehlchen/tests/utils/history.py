@@ -1066,3 +1066,7 @@ def maybe_mock_historical_price_queries(
         return price
 
     historian.query_historical_price = mock_historical_price_query
+    # Bulk price queries go straight to the oracles so mock those too
+    historian._query_oracles = mock_historical_price_query
+    # and don't mix the mocked prices with the persisted ones of other tests
+    historian._price_cache = None
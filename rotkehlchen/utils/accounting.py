@@ -2,8 +2,10 @@ from typing import Optional, Tuple, Union
 
 from rotkehlchen.accounting.structures import DefiEvent
 from rotkehlchen.assets.asset import Asset
+from rotkehlchen.assets.unknown_asset import UnknownEthereumToken
 from rotkehlchen.chain.ethereum.trades import AMMTrade
 from rotkehlchen.constants.assets import A_ETH
+from rotkehlchen.errors import DeserializationError, UnknownAsset, UnsupportedAsset
 from rotkehlchen.exchanges.data_structures import (
     AssetMovement,
     Loan,
@@ -22,6 +24,10 @@ TaxableAction = Union[  # TODO: At this point we perhaps should create an interf
     DefiEvent,
     AMMTrade,
 ]
+AssetError = Union[UnknownAsset, UnsupportedAsset, DeserializationError]
+# AMM trades may involve tokens that are not known to us
+ActionAsset = Union[Asset, UnknownEthereumToken]
+ActionAssets = Union[Tuple[ActionAsset, Optional[ActionAsset]], AssetError]
 
 
 def action_get_timestamp(action: TaxableAction) -> Timestamp:
@@ -70,3 +76,20 @@ def action_get_assets(
         return action.currency, None
     # else
     raise AssertionError(f'TaxableAction of unknown type {type(action)} encountered')
+
+
+def action_get_assets_safe(action: TaxableAction) -> ActionAssets:
+    """Same as action_get_assets but returns the asset error instead of raising it
+
+    This lets the assets of each action be resolved once at the start of history
+    processing and the result be checked wherever it is later needed. Unlike
+    action_get_assets the assets of AMM trades are typed as the possibly unknown
+    tokens they are.
+    """
+    if isinstance(action, AMMTrade):
+        return action.base_asset, action.quote_asset
+
+    try:
+        return action_get_assets(action)
+    except (UnknownAsset, UnsupportedAsset, DeserializationError) as e:
+        return e
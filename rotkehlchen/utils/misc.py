@@ -16,7 +16,7 @@ import requests
 from eth_utils.address import to_checksum_address
 from rlp.sedes import big_endian_int
 
-from rotkehlchen.constants import ALL_REMOTES_TIMEOUT, ZERO
+from rotkehlchen.constants import ALL_REMOTES_TIMEOUT, WEI_DIVISOR, ZERO
 from rotkehlchen.constants.timing import QUERY_RETRY_TIMES
 from rotkehlchen.errors import (
     ConversionError,
@@ -99,7 +99,7 @@ def timestamp_to_date(ts: Timestamp, formatstr: str = '%d/%m/%Y %H:%M:%S') -> st
 
 
 def from_wei(wei_value: FVal) -> FVal:
-    return wei_value / FVal(10 ** 18)
+    return wei_value / WEI_DIVISOR
 
 
 def from_gwei(gwei_value: Union[FVal, int]) -> FVal: